@@ -1,23 +1,59 @@
 import os
+import fcntl
+import logging
+import logging.handlers
+import queue
+import atexit
 import hmac
-import hashlib
-import json
+import time
 from urllib.parse import parse_qsl
-from operator import itemgetter
-import sqlite3
 import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
 
 import libsql_experimental as libsql
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.routing import APIRoute
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, ValidationError
 from aiogram import Bot, Dispatcher, Router, types
 
 # Загружаем переменные окружения (Railway Variables)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_URL = os.getenv("DB_URL")
 DB_TOKEN = os.getenv("DB_TOKEN")
+# Публичный адрес приложения для вебхука Telegram; без него бот работает через long polling.
+# На Railway адрес берётся из RAILWAY_PUBLIC_DOMAIN, если публичный домен выдан.
+PUBLIC_URL = os.getenv("PUBLIC_URL") or (
+    f"https://{os.environ['RAILWAY_PUBLIC_DOMAIN']}" if os.getenv("RAILWAY_PUBLIC_DOMAIN") else None
+)
 
-# Инициализация FastAPI
-app = FastAPI()
+# Логирование вместо print: подробные сообщения обработчиков выводятся только на уровне DEBUG.
+# Записи кладутся в очередь, а в stderr их пишет отдельный поток, чтобы запись в поток
+# вывода не блокировала цикл событий.
+log_queue = queue.SimpleQueue()
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(message)s",
+    handlers=[logging.handlers.QueueHandler(log_queue)],
+)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger("app")
+
+# Секретный ключ для проверки initData: HMAC-SHA256 токена бота с ключом "WebAppData".
+# Токен не меняется во время работы, поэтому ключ вычисляется один раз при запуске.
+SECRET_KEY = hmac.digest(b"WebAppData", BOT_TOKEN.encode(), "sha256")
+# Состояние HMAC с уже применённым ключом: при проверке достаточно скопировать его,
+# а не заново обрабатывать ключевые блоки ipad/opad на каждый запрос
+SECRET_HMAC = hmac.new(SECRET_KEY, digestmod="sha256")
+# Секрет вебхука: Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hmac.digest(SECRET_KEY, b"webhook", "sha256").hex()
+WEBHOOK_PATH = "/tg/webhook"
 
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
@@ -25,200 +61,463 @@ dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-# Подключение к удалённой базе (например, Turso) через libsql
-remote_conn = libsql.connect("miniappbd", sync_url=DB_URL, auth_token=DB_TOKEN)
-remote_conn.sync()  # Принудительная синхронизация перед SQL-запросами
-
-# Создаём таблицу в удалённой БД, если её нет
-remote_conn.execute("""
-    CREATE TABLE IF NOT EXISTS clicks (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        clicks INTEGER DEFAULT 0
-    )
-""")
-remote_conn.commit()
-
-# Создание локальной базы данных (SQLite) для асинхронных записей
-local_conn = sqlite3.connect("local.db", check_same_thread=False)
-local_conn.row_factory = sqlite3.Row
-local_cursor = local_conn.cursor()
-local_cursor.execute("""
-    CREATE TABLE IF NOT EXISTS local_clicks (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        clicks INTEGER DEFAULT 0
-    )
-""")
-local_conn.commit()
+# Файлы блокировок, удерживаемые процессом до завершения
+_worker_locks = []
+
+def acquire_worker_slot() -> int:
+    """
+    Занимает первый свободный номер воркера через файловую блокировку.
+
+    При запуске с несколькими воркерами номер 0 достаётся ровно одному процессу:
+    только он регистрирует вебхук или опрашивает Telegram (параллельные getUpdates
+    конфликтуют). Номер также
+    разводит воркеров по отдельным файлам реплики. Блокировка снимается ОС
+    при завершении процесса, поэтому номера освобождаются при перезапуске.
+    """
+    slot = 0
+    while True:
+        lock_file = open(f"worker-{slot}.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            slot += 1
+            continue
+        _worker_locks.append(lock_file)
+        return slot
+
+# Встроенная реплика Turso (libsql): чтения идут из локального файла реплики,
+# записи уходят в удалённую БД, а libsql сам подтягивает изменения каждые sync_interval секунд.
+# Соединение открывается в lifespan каждого воркера, а не при импорте: управляющему
+# процессу сервера соединение не нужно.
+DB_SYNC_INTERVAL = 60  # секунды
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+db = None  # соединение-писатель (у libsql один писатель)
+read_pool = None  # пул соединений только для чтения из файла реплики
+
+def replica_path(worker_slot: int) -> str:
+    """У каждого воркера свой файл реплики: один файл нельзя синхронизировать из нескольких процессов."""
+    return "miniappbd" if worker_slot == 0 else f"miniappbd-{worker_slot}"
+
+def init_db(db_path: str):
+    """Открывает реплику, синхронизирует её и создаёт таблицу в удалённой БД, если её нет."""
+    global db
+    db = libsql.connect(db_path, sync_url=DB_URL, auth_token=DB_TOKEN, sync_interval=DB_SYNC_INTERVAL)
+    db.sync()  # Принудительная синхронизация перед SQL-запросами
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS clicks (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            clicks INTEGER DEFAULT 0
+        )
+    """)
+    # Покрывающий индекс: таблица лидеров читается из индекса без сортировки и обращений к таблице
+    db.execute("CREATE INDEX IF NOT EXISTS idx_clicks_desc ON clicks(clicks DESC, username)")
+    db.commit()
+
+# Настройки соединений для чтения: ждём (а не падаем с SQLITE_BUSY), пока libsql
+# применяет синхронизацию, и держим временные данные и 16 МБ кэша страниц в памяти.
+# Режим журнала и synchronous здесь не трогаем: файлом реплики и его записью
+# управляет libsql через соединение-писатель.
+READ_PRAGMAS = (
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+def open_reader(db_path: str):
+    """Открывает соединение только для чтения к локальному файлу реплики."""
+    conn = libsql.connect(db_path)
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def open_readers(db_path: str, count: int) -> list:
+    """Открывает count соединений для чтения (выполняется в потоке БД)."""
+    return [open_reader(db_path) for _ in range(count)]
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений для чтения.
+
+    Соединения открываются напрямую к локальному файлу реплики, поэтому читатели
+    не ждут друг друга и соединение-писатель. Размер пула задаёт DB_POOL_SIZE.
+    """
+
+    def __init__(self, connections: list):
+        self._connections = asyncio.Queue()
+        for conn in connections:
+            self._connections.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put_nowait(conn)
+
+# Сколько секунд Telegram держит getUpdates открытым, если обновлений нет (максимум 50).
+# Чем дольше, тем реже простаивающий бот будит цикл событий новыми запросами
+POLLING_TIMEOUT = 30
+
+async def start_bot_polling():
+    """Запасной режим без публичного адреса: long polling вместо вебхука."""
+    # Вебхук и getUpdates взаимоисключающие: снимаем вебхук, оставшийся от прошлого запуска
+    await bot.delete_webhook()
+    # Сигналы остановки обрабатывает ASGI-сервер, а не aiogram.
+    # allowed_updates aiogram сам выводит из зарегистрированных обработчиков (только message)
+    await dp.start_polling(bot, polling_timeout=POLLING_TIMEOUT, handle_signals=False)
+
+async def stop_bot_polling(polling: asyncio.Task):
+    """
+    Останавливает long polling до финального сброса кликов.
+
+    Отмена задачи polling не останавливает: start_polling оставляет внутренние задачи
+    getUpdates работать и заново открывает сессию бота. Поэтому сначала просим aiogram
+    завершить опрос через dp.stop_polling(), а отмену используем лишь как запасной вариант.
+    """
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        # Опрос ещё не начался (снимаем вебхук) или уже завершился с ошибкой
+        pass
+    polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+
+# Жизненный цикл приложения: готовим БД до приёма запросов,
+# запускаем бота и фоновые задачи, а при остановке корректно их завершаем
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global read_pool
+    worker_slot = acquire_worker_slot()
+    db_path = replica_path(worker_slot)
+    await in_db_thread(init_db, db_path)
+    # Открытие соединений и PRAGMA — блокирующий ввод-вывод, поэтому соединения открываются
+    # в потоке, а сам пул (его asyncio.Queue) создаётся здесь, в цикле событий
+    readers = await in_db_thread(open_readers, db_path, DB_POOL_SIZE)
+    read_pool = ConnectionPool(readers)
+    flusher = asyncio.create_task(flush_clicks())
+    polling = None
+    if worker_slot == 0:
+        if PUBLIC_URL:
+            # Telegram сам присылает обновления на WEBHOOK_PATH, их принимает любой воркер
+            await bot.set_webhook(
+                f"{PUBLIC_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        else:
+            polling = asyncio.create_task(start_bot_polling())
+    yield
+    if polling is not None:
+        await stop_bot_polling(polling)
+    await bot.session.close()
+    # Задачу сброса не отменяем, а просим завершиться: отмена посреди записи
+    # оставила бы поток работать с соединением-писателем без блокировки
+    flush_stop.set()
+    clicks_pending.set()
+    await flusher
+    # Сохраняем оставшиеся в памяти клики
+    await flush_pending_clicks()
+    DB_EXECUTOR.shutdown(wait=False)
+
+class ORJSONRequest(Request):
+    """Запрос, тело которого разбирается через orjson вместо стандартного json."""
+
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """Маршрут, передающий обработчику ORJSONRequest (ошибки разбора по-прежнему дают 422)."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def orjson_handler(request: Request):
+            return await handler(ORJSONRequest(request.scope, request.receive))
+
+        return orjson_handler
+
+# Инициализация FastAPI (тела запросов и ответы сериализуются через orjson)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.router.route_class = ORJSONRoute
 
 # Функция проверки подписи согласно рекомендациям Telegram WebApp
-def check_webapp_signature(token: str, init_data: str) -> bool:
+def check_webapp_signature(parsed_data: dict, received_hash: str) -> bool:
     """
     Проверяет подпись initData, переданного от Telegram WebApp.
 
+    Принимает уже разобранный initData (без параметра "hash") и сам "hash",
+    чтобы вызывающему коду не приходилось разбирать строку повторно.
+
     Алгоритм:
-      1. Разбираем init_data как query string.
-      2. Удаляем параметр "hash".
-      3. Формируем строку вида: "key1=value1\nkey2=value2\n..." (ключи сортируются лексикографически).
-      4. Вычисляем секретный ключ как HMAC с ключом "WebAppData" и токеном бота.
-      5. Вычисляем контрольный хэш.
-      6. Сравниваем вычисленный хэш с полученным.
+      1. Декодируем полученный хэш из hex.
+      2. Формируем строку вида: "key1=value1\nkey2=value2\n..." (ключи сортируются лексикографически).
+      3. Вычисляем контрольный хэш копией заранее подготовленного HMAC (SECRET_HMAC).
+      4. Сравниваем вычисленный хэш с полученным за постоянное время (hmac.compare_digest).
     """
     try:
-        parsed_data = dict(parse_qsl(init_data))
+        received_digest = bytes.fromhex(received_hash)
     except ValueError:
         return False
-    if "hash" not in parsed_data:
-        return False
-    received_hash = parsed_data.pop("hash")
-    data_check_string = "\n".join(
-        f"{k}={v}" for k, v in sorted(parsed_data.items(), key=itemgetter(0))
-    )
-    secret_key = hmac.new(key=b"WebAppData", msg=token.encode(), digestmod=hashlib.sha256)
-    calculated_hash = hmac.new(
-        key=secret_key.digest(),
-        msg=data_check_string.encode(),
-        digestmod=hashlib.sha256
-    ).hexdigest()
-    return calculated_hash == received_hash
-
-# Фоновая задача для синхронизации локальной и удалённой баз данных
-async def sync_databases():
-    """
-    Каждые 10 минут:
-      1. Считывает из локальной БД топ-100 пользователей (по кликам).
-      2. Для каждого пользователя обновляет (или вставляет) запись в удалённой БД,
-         суммируя локальные клики с удалёнными.
-      3. После успешной синхронизации удаляет обработанные записи из локальной БД.
-      4. Затем считывает актуальные данные из удалённой БД и обновляет локальную БД (UPSERT).
+    data_check_string = "\n".join([f"{k}={v}" for k, v in sorted(parsed_data.items())])
+    mac = SECRET_HMAC.copy()
+    mac.update(data_check_string.encode())
+    calculated_digest = mac.digest()
+    return hmac.compare_digest(calculated_digest, received_digest)
+
+
+# Отдельный пул потоков для работы с БД: по потоку на каждое соединение (читатели + писатель),
+# чтобы запросы к БД не конкурировали за потоки с остальными задачами asyncio.to_thread
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_SIZE + 1, thread_name_prefix="db")
+
+async def in_db_thread(func, *args):
     """
-    while True:
+    Выполняет блокирующую функцию в пуле потоков DB_EXECUTOR.
+
+    Отмена не останавливает уже запущенный поток, поэтому при отмене сначала
+    дожидаемся его завершения: иначе db_lock или соединение из read_pool
+    освободились бы, пока поток ещё с ними работает.
+    """
+    future = asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait((future,))
+        raise
+
+# Блокировка соединения-писателя: оно не рассчитано на одновременную работу из нескольких потоков.
+# Под ней же забираются клики из pending_clicks на запись: пока блокировка удерживается,
+# каждый клик либо уже записан в БД, либо ещё лежит в pending_clicks
+db_lock = asyncio.Lock()
+
+async def run_read(func, *args):
+    """Выполняет блокирующее чтение в пуле потоков на свободном соединении из read_pool."""
+    async with read_pool.acquire() as conn:
+        return await in_db_thread(func, conn, *args)
+
+# Запросы горячего пути (у libsql-experimental нет conn.prepare(), поэтому SQL хранится в константах)
+SQL_ADD_CLICKS = """
+    INSERT INTO clicks (user_id, username, clicks)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET clicks = clicks + excluded.clicks
+"""
+# Один UPSERT вместо SELECT + INSERT; заодно обновляем username, если пользователь его сменил
+SQL_AUTH_USER = """
+    INSERT INTO clicks (user_id, username, clicks)
+    VALUES (?, ?, 0)
+    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+    RETURNING clicks
+"""
+SQL_STATS = "SELECT username, clicks FROM clicks ORDER BY clicks DESC"
+
+def get_or_create_user(user_id: int, username: str) -> int:
+    """Возвращает количество кликов пользователя, создавая запись или обновляя username."""
+    row = db.execute(SQL_AUTH_USER, (user_id, username)).fetchone()
+    db.commit()
+    return row[0]
+
+def add_clicks(counts: dict):
+    """Прибавляет накопленные клики {user_id: количество} одной транзакцией."""
+    db.executemany(SQL_ADD_CLICKS, [(user_id, "Unknown", clicks) for user_id, clicks in counts.items()])
+    db.commit()
+
+def fetch_stats(conn) -> bytes:
+    """
+    Возвращает готовый JSON пользователей, отсортированных по количеству кликов
+    (читается из реплики). Сериализация выполняется здесь же, в потоке БД,
+    чтобы большая таблица лидеров не занимала цикл событий.
+    """
+    cursor = conn.execute(SQL_STATS)
+    return orjson.dumps([{"username": username, "clicks": clicks} for username, clicks in cursor.fetchall()])
+
+# Клики, накопленные в памяти до сброса в БД ({user_id: количество}).
+# Изменяется только из цикла событий, поэтому отдельная блокировка не нужна.
+pending_clicks = defaultdict(int)
+# Взводится при появлении новых кликов, чтобы задача сброса не просыпалась впустую
+clicks_pending = asyncio.Event()
+CLICK_FLUSH_INTERVAL = 0.2  # секунды
+# После неудачного сброса пауза удваивается до этого предела, чтобы при недоступной БД
+# не повторять запись (и не держать db_lock) по пять раз в секунду
+CLICK_FLUSH_MAX_RETRY_DELAY = 5.0  # секунды
+# Взводится при остановке приложения: задача сброса завершается сама, не прерывая запись
+flush_stop = asyncio.Event()
+
+def add_pending_click(user_id: int):
+    """Учитывает клик в памяти; в БД он попадёт при ближайшем сбросе."""
+    pending_clicks[user_id] += 1
+    clicks_pending.set()
+
+async def write_pending_clicks():
+    """
+    Забирает накопленные клики и записывает их в БД. Всё это происходит под db_lock,
+    поэтому запрос авторизации не увидит клики, которые уже не в памяти, но ещё не в БД.
+    """
+    async with db_lock:
+        if not pending_clicks:
+            return
+        snapshot = dict(pending_clicks)
+        pending_clicks.clear()
         try:
-            print("🔄 [Sync] Начало синхронизации локальной и удалённой БД")
-            # Считываем топ-100 пользователей по кликам из локальной БД
-            local_cursor.execute("SELECT * FROM local_clicks ORDER BY clicks DESC LIMIT 100")
-            local_rows = local_cursor.fetchall()
-            if local_rows:
-                for row in local_rows:
-                    user_id = row["user_id"]
-                    username = row["username"]
-                    local_clicks = row["clicks"]
-                    result = remote_conn.execute("SELECT clicks FROM clicks WHERE user_id = ?", (user_id,))
-                    remote_row = result.fetchone()
-                    if remote_row:
-                        new_clicks = remote_row[0] + local_clicks
-                        remote_conn.execute("UPDATE clicks SET clicks = ? WHERE user_id = ?", (new_clicks, user_id))
-                    else:
-                        remote_conn.execute("INSERT INTO clicks (user_id, username, clicks) VALUES (?, ?, ?)",
-                                             (user_id, username, local_clicks))
-                remote_conn.commit()
-
-                # Удаляем обработанные записи из локальной БД
-                user_ids = [row["user_id"] for row in local_rows]
-                placeholders = ",".join("?" for _ in user_ids)
-                local_cursor.execute(f"DELETE FROM local_clicks WHERE user_id IN ({placeholders})", user_ids)
-                local_conn.commit()
-
-                # Считываем актуальные данные из удалённой БД и обновляем локальную БД
-                result = remote_conn.execute("SELECT * FROM clicks")
-                remote_rows = result.fetchall()
-                for row in remote_rows:
-                    user_id = row[0]
-                    username = row[1]
-                    clicks = row[2]
-                    local_cursor.execute("""
-                        INSERT INTO local_clicks (user_id, username, clicks)
-                        VALUES (?, ?, ?)
-                        ON CONFLICT(user_id) DO UPDATE SET clicks = excluded.clicks
-                    """, (user_id, username, clicks))
-                local_conn.commit()
-                print("✅ [Sync] Синхронизация завершена для", len(user_ids), "пользователей")
-            else:
-                print("🔄 [Sync] Нет данных для синхронизации")
+            await in_db_thread(add_clicks, snapshot)
+        except BaseException:
+            # Возвращаем клики обратно до снятия блокировки, чтобы не потерять их до следующего сброса
+            for user_id, clicks in snapshot.items():
+                pending_clicks[user_id] += clicks
+            clicks_pending.set()
+            raise
+    # Таблица лидеров устарела: следующий запрос /api/stats перечитает её из реплики
+    stats_cache["expires"] = 0.0
+
+async def flush_pending_clicks():
+    """Сбрасывает накопленные в памяти клики в БД."""
+    if not pending_clicks:
+        return
+    # Запись идёт отдельной задачей, защищённой от отмены вызывающего: отмена не прерывает
+    # поток, и задача записи сама знает, удалась ли запись и нужно ли вернуть клики
+    write = asyncio.create_task(write_pending_clicks())
+    # Если вызывающего отменили, ошибку записи никто не дождётся: забираем её сами
+    # (клики уже возвращены, а ошибку залогирует следующий сброс)
+    write.add_done_callback(lambda task: task.cancelled() or task.exception())
+    await asyncio.shield(write)
+
+async def get_user_clicks(user_id: int, username: str) -> int:
+    """
+    Возвращает клики пользователя: записанные в БД плюс ещё не сброшенные из памяти.
+    Оба значения читаются под db_lock, поэтому клики из сброса, который идёт прямо
+    сейчас, не выпадают из результата.
+    """
+    async with db_lock:
+        user_clicks = await in_db_thread(get_or_create_user, user_id, username)
+        return user_clicks + pending_clicks.get(user_id, 0)
+
+# Фоновая задача сброса кликов: ждёт первого клика, копит клики ещё
+# CLICK_FLUSH_INTERVAL секунд (после ошибок дольше) и записывает их одной транзакцией.
+# Работает до взвода flush_stop (оставшиеся клики при остановке сбрасывает lifespan)
+async def flush_clicks():
+    delay = CLICK_FLUSH_INTERVAL
+    while not flush_stop.is_set():
+        await clicks_pending.wait()
+        try:
+            # Пауза перед сбросом, которую прерывает остановка приложения
+            await asyncio.wait_for(flush_stop.wait(), delay)
+            break
+        except asyncio.TimeoutError:
+            pass
+        clicks_pending.clear()
+        try:
+            await flush_pending_clicks()
         except Exception as e:
-            print("❌ [Sync] Ошибка синхронизации:", e)
-        await asyncio.sleep(600)  # 10 минут
+            delay = min(delay * 2, CLICK_FLUSH_MAX_RETRY_DELAY)
+            logger.error("❌ [Flush] Ошибка записи кликов (повтор через %.1f с): %s", delay, e)
+        else:
+            delay = CLICK_FLUSH_INTERVAL
+
+# Тела запросов: разбор и проверка JSON выполняются в pydantic-core
+class AuthIn(BaseModel):
+    initData: Optional[str] = None
+
+class ClickIn(BaseModel):
+    user_id: int
+
+# Поле "user" из initData: JSON-строка, которую разбирает и проверяет pydantic-core
+class TelegramUser(BaseModel):
+    id: int
+    username: str = "Unknown"
+
+# Длина initData, начиная с которого проверка подписи выполняется в пуле потоков
+SIGNATURE_THREAD_THRESHOLD = 2048
 
 # Endpoint авторизации
 @app.post("/api/auth")
-async def auth_endpoint(data: dict):
+async def auth_endpoint(data: AuthIn):
     """
     Ожидает, что клиент пришлёт JSON с полем "initData",
     содержащим исходную строку данных от Telegram.
     """
-    init_data = data.get("initData")
-    print("🔹 [API] initData:", init_data)
+    init_data = data.initData
+    logger.debug("🔹 [API] initData: %s", init_data)
     if not init_data:
         raise HTTPException(status_code=400, detail="Missing initData")
-    if not check_webapp_signature(BOT_TOKEN, init_data):
+    try:
+        parsed_data = dict(parse_qsl(init_data))
+    except ValueError:
+        raise HTTPException(status_code=403, detail="Invalid auth")
+    received_hash = parsed_data.pop("hash", None)
+    if not received_hash:
+        raise HTTPException(status_code=403, detail="Invalid auth")
+    # Обычный initData проверяется за микросекунды, и переход в поток стоил бы дороже самой проверки;
+    # в пул потоков уходят только крупные строки, на которых hashlib отпускает GIL
+    if len(init_data) > SIGNATURE_THREAD_THRESHOLD:
+        valid = await asyncio.to_thread(check_webapp_signature, parsed_data, received_hash)
+    else:
+        valid = check_webapp_signature(parsed_data, received_hash)
+    if not valid:
         raise HTTPException(status_code=403, detail="Invalid auth")
-    parsed_data = dict(parse_qsl(init_data))
     user_json = parsed_data.get("user")
     if not user_json:
         raise HTTPException(status_code=400, detail="Missing user data")
     try:
-        user_obj = json.loads(user_json)
-    except Exception as e:
+        user = TelegramUser.model_validate_json(user_json)
+    except ValidationError:
         raise HTTPException(status_code=400, detail="Invalid user data format")
-    user_id = int(user_obj["id"])
-    username = user_obj.get("username", "Unknown")
-    # Читаем статистику из локальной БД
-    local_cursor.execute("SELECT clicks FROM local_clicks WHERE user_id = ?", (user_id,))
-    row = local_cursor.fetchone()
-    if row:
-        user_clicks = row["clicks"]
-    else:
-        local_cursor.execute("INSERT INTO local_clicks (user_id, username, clicks) VALUES (?, ?, ?)",
-                             (user_id, username, 0))
-        local_conn.commit()
-        user_clicks = 0
-    print(f"✅ [API] Пользователь {user_id} ({username}), кликов: {user_clicks}")
+    user_id = user.id
+    username = user.username
+    # Создаём пользователя (или обновляем имя) и читаем его клики. Счётчик берём из
+    # удалённой БД (UPSERT ... RETURNING), а не из локальной реплики: реплика этого воркера
+    # видит сбросы других воркеров лишь раз в DB_SYNC_INTERVAL, и счётчик мог бы уменьшиться
+    user_clicks = await get_user_clicks(user_id, username)
+    logger.debug("✅ [API] Пользователь %s (%s), кликов: %s", user_id, username, user_clicks)
     return {"user_id": user_id, "clicks": user_clicks}
 
-# Endpoint для записи клика (только в локальную БД)
+# Endpoint для записи клика (копится в памяти, затем сбрасывается в БД)
 @app.post("/api/click")
-async def record_click(data: dict):
-    user_id = data["user_id"]
-    print(f"🔹 [API] Получен клик от {user_id}")
-    local_cursor.execute("UPDATE local_clicks SET clicks = clicks + 1 WHERE user_id = ?", (user_id,))
-    if local_cursor.rowcount == 0:
-        local_cursor.execute("INSERT INTO local_clicks (user_id, username, clicks) VALUES (?, ?, ?)",
-                             (user_id, "Unknown", 1))
-    local_conn.commit()
+async def record_click(data: ClickIn):
+    user_id = data.user_id
+    add_pending_click(user_id)
     return {"status": "ok"}
 
-# Endpoint для получения статистики (из локальной БД)
+# Кэш таблицы лидеров: готовый JSON и момент устаревания (по time.monotonic()).
+# Таблица лидеров может отставать на пару секунд, зато повторные запросы не трогают БД.
+# Клики в БД записывает только задача сброса, а удачный сброс обнуляет "expires".
+STATS_CACHE_TTL = 2.0  # секунды
+stats_cache = {"body": None, "expires": 0.0}
+stats_lock = asyncio.Lock()
+
+# Endpoint для получения статистики (из локальной реплики, с кэшированием)
 @app.get("/api/stats")
 async def get_stats():
-    print("🔹 [API] Запрос статистики")
-    local_cursor.execute("SELECT username, clicks FROM local_clicks ORDER BY clicks DESC")
-    rows = local_cursor.fetchall()
-    stats = [{"username": row["username"], "clicks": row["clicks"]} for row in rows]
-    return stats
+    logger.debug("🔹 [API] Запрос статистики")
+    if time.monotonic() >= stats_cache["expires"]:
+        # Обновляет кэш только один запрос, остальные дожидаются его результата
+        async with stats_lock:
+            if time.monotonic() >= stats_cache["expires"]:
+                stats_cache["body"] = await run_read(fetch_stats)
+                stats_cache["expires"] = time.monotonic() + STATS_CACHE_TTL
+    return Response(content=stats_cache["body"], media_type="application/json")
 
-# Бот принимает клики от Mini App (обновляет локальную БД)
+# Бот принимает клики от Mini App (копятся вместе с кликами из API)
 @router.message(lambda message: message.web_app_data is not None)
 async def handle_webapp_data(message: types.Message):
-    data = json.loads(message.web_app_data.data)
+    data = orjson.loads(message.web_app_data.data)
     user_id = message.from_user.id
-    print(f"🔹 [Bot] Клик от {user_id}, обновляем в локальной БД")
-    local_cursor.execute("UPDATE local_clicks SET clicks = clicks + 1 WHERE user_id = ?", (user_id,))
-    if local_cursor.rowcount == 0:
-        local_cursor.execute("INSERT INTO local_clicks (user_id, username, clicks) VALUES (?, ?, ?)",
-                             (user_id, "Unknown", 1))
-    local_conn.commit()
+    add_pending_click(user_id)
     await message.answer(f"Ваши клики: {data['clicks']}")
 
-# Запускаем бота и фоновые задачи через событие startup FastAPI
-@app.on_event("startup")
-async def startup_event():
-    # Запускаем фоновую задачу синхронизации
-    asyncio.create_task(sync_databases())
-    # Запускаем бота
-    asyncio.create_task(dp.start_polling(bot))
+# Вебхук Telegram: обновления передаются в диспетчер aiogram
+@app.post(WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Invalid secret")
+    await dp.feed_webhook_update(bot, orjson.loads(await request.body()))
+    return {"ok": True}
 
-# Если запускаем приложение напрямую (например, для отладки локально)
+# Если запускаем приложение напрямую (например, для отладки локально).
+# Здесь один процесс: несколько воркеров запускаются через CLI uvicorn (см. railway.json)
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", access_log=False)